@@ -200,7 +200,17 @@ class LlamaForSampling(module.WrappingCheckpointCompatibleModel, base.NeuronMode
         return logits
 
     def sample(self, input_ids, sequence_length, start_ids=None,
-               top_k=50, top_p=1.0, eos_token_override=None, temperature=1.0, streamer=None):
+               top_k=50, top_p=1.0, eos_token_override=None, temperature=1.0, streamer=None, pad_token_id=0):
+
+        # A list of independent 1-D prompts is left-padded with pad_token_id
+        # into one batch, with start_ids marking where each prompt begins.
+        if isinstance(input_ids, (list, tuple)):
+            if start_ids is not None:
+                raise ValueError('start_ids are derived from the prompt lengths when input_ids is a list of prompts.')
+            if self.prefixed_length:
+                # Left-padding shifts the shared prefix away from the leading columns of shorter prompts
+                raise ValueError('A list of prompts cannot be sampled with a prefixed_length.')
+            input_ids, start_ids = sampling.batch_prompts(input_ids, pad_token_id)
 
         # To enable optimized context encoding network, we must pad
         # up to the context length estimate or we will not correctly
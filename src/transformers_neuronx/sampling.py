@@ -15,6 +15,73 @@
 import torch
 
 
+def sample_categorical(logits):
+    """
+    Draw one index per row from ``softmax(logits)`` using the Gumbel-max trick.
+
+    Equivalent in distribution to ``torch.multinomial(softmax(logits), num_samples=1)``
+    but avoids its high per-call overhead on small (batch, top_k) tensors:
+    ``argmax(logits + g)`` with ``g ~ Gumbel(0, 1)`` is a sample from ``softmax(logits)``.
+    Since the argmax is unaffected by normalization, no softmax is required.
+    """
+    # Computed in place to avoid allocating a temporary per elementwise op. rand_like can return
+    # exactly 0.0, which would become -inf noise and make that candidate impossible to sample.
+    uniform = torch.rand_like(logits).clamp_(min=torch.finfo(logits.dtype).tiny)
+    gumbel = uniform.log_().neg_().log_().neg_()
+    return torch.argmax(gumbel.add_(logits), dim=-1, keepdim=True)
+
+
+def sample_top_k(next_token_scores, eos_ids, top_k):
+    """
+    A single top-k sampling step: masks EOS, selects the top-k scores and samples one token per row.
+
+    `eos_ids` is a 1-D index tensor holding the EOS token id, built once per
+    generation. The EOS mask is written into `next_token_scores` in place.
+    """
+    # don't sample EOS
+    next_token_scores.index_fill_(1, eos_ids, -float('inf'))
+
+    # Remove all tokens with a probability less than the last token of the top-k
+    topk_values, topk_indices = torch.topk(next_token_scores, top_k, sorted=False)
+
+    # sample
+    inputs_in_topk = sample_categorical(topk_values)
+    return torch.gather(topk_indices, 1, inputs_in_topk)
+
+
+def allocate_tokens(input_ids, sequence_length):
+    """
+    Allocates the output of a sampling loop with the prompt already written to its leading columns.
+
+    Sampled tokens are written into the returned tensor in place, avoiding a
+    per-token allocation and a concatenation at the end of the loop.
+    """
+    batch_size, start = input_ids.shape
+    tokens = torch.empty((batch_size, max(start, sequence_length)), dtype=input_ids.dtype, device=input_ids.device)
+    tokens[:, :start] = input_ids
+    return tokens
+
+
+def batch_prompts(prompts, pad_token_id=0):
+    """
+    Left-pads independent prompts of different lengths into a single batch.
+
+    Returns the padded (batch, max_length) input ids and the start ids which
+    mark the first non-padding position of each row. Sampling the batch then
+    performs one top-k/top-p selection over all rows per step rather than one
+    per prompt.
+    """
+    if not prompts:
+        raise ValueError('At least one prompt is required.')
+    lengths = [prompt.numel() for prompt in prompts]
+    max_length = max(lengths)
+    input_ids = torch.full((len(prompts), max_length), pad_token_id, dtype=prompts[0].dtype)
+    for row, (prompt, length) in enumerate(zip(prompts, lengths)):
+        input_ids[row, max_length - length:] = prompt.flatten()
+    start_ids = torch.tensor([max_length - length for length in lengths], dtype=torch.int32)
+    return input_ids, start_ids
+
+
 @torch.no_grad()
 def simple_sample(model, input_ids, start_ids, sequence_length, eos_token_id=2, top_k=50, streamer=None, output_scores=False):
     # populate key/value caches according to the prompt text
@@ -38,20 +105,24 @@ def sample_tokens(model, input_ids, start_ids=None, sequence_length=128):
     cache_ids = torch.arange(start, dtype=torch.int32)
     next_tokens = model(input_ids, cache_ids, start_ids)
 
-    cache_ids = torch.arange(start, sequence_length, dtype=torch.int32).split(1)
-    tokens = [input_ids]
+    # Reused for every decode step rather than allocating one tensor per token
+    cache_ids = torch.empty(1, dtype=torch.int32)
+    tokens = allocate_tokens(input_ids, sequence_length)
 
-    for current, cache_id in zip(range(start + 1, sequence_length + 1), cache_ids):
+    for cur_len in range(start, sequence_length):
+        next_len = cur_len + 1
 
-        tokens.append(next_tokens)
-        if current >= sequence_length:
+        tokens[:, cur_len:next_len] = next_tokens
+        if next_len >= sequence_length:
             break
 
-        next_tokens = model(next_tokens, cache_id, start_ids)
+        cache_ids.fill_(cur_len)
+        next_tokens = model(next_tokens, cache_ids, start_ids)
 
-    return torch.cat(tokens, dim=-1)
+    return tokens
 
 
+@torch.no_grad()
 def sample_greedy(model, input_ids, start_ids=None, sequence_length=128):
     """
     A sampling loop that selects tokens according to the most probable score.
@@ -62,41 +133,36 @@ def sample_greedy(model, input_ids, start_ids=None, sequence_length=128):
     cache_ids = torch.arange(start, dtype=torch.int32)
     next_token_scores = model(input_ids, cache_ids, start_ids)
 
-    tokens = [input_ids]
+    cache_ids = torch.empty(1, dtype=torch.int32)
+    tokens = allocate_tokens(input_ids, sequence_length)
     for cur_len in range(start, sequence_length):
 
         # greedy sample
         inputs = torch.argmax(next_token_scores, dim=1, keepdim=True)
-        tokens.append(inputs)
+        tokens[:, cur_len:cur_len + 1] = inputs
 
         # forward pass to get next token
-        cache_ids = torch.as_tensor([cur_len], dtype=torch.int32)
+        cache_ids.fill_(cur_len)
         next_token_scores = model(inputs, cache_ids, start_ids)
 
-    return torch.cat(tokens, dim=-1)
+    return tokens
 
 
+@torch.no_grad()
 def sample_loop(model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id=2,
                 top_k=50, streamer=None, output_scores=False):
-    tokens = [input_ids]
+    tokens = allocate_tokens(input_ids, sequence_length)
     _, start = input_ids.shape
+    cache_ids = torch.empty(1, dtype=torch.int32)
     scores = []
+    eos_ids = torch.tensor([eos_token_id], device=next_token_scores.device)
     for cur_len in range(start, sequence_length):
         next_len = cur_len + 1
 
-        # don't sample EOS
-        next_token_scores[:, eos_token_id] = -float('inf')
-
-        # Remove all tokens with a probability less than the last token of the top-k
+        inputs = sample_top_k(next_token_scores, eos_ids, top_k)
         if output_scores:
             scores.append(next_token_scores)
-        topk_values, topk_indices = torch.topk(next_token_scores, top_k)
-
-        # sample
-        probs = torch.nn.functional.softmax(topk_values, dim=-1)
-        inputs_in_topk = torch.multinomial(probs, num_samples=1, replacement=True)
-        inputs = torch.gather(topk_indices, 1, inputs_in_topk)
-        tokens.append(inputs)
+        tokens[:, cur_len:next_len] = inputs
 
         if streamer:
             streamer.put(inputs)
@@ -105,16 +171,16 @@ def sample_loop(model, input_ids, start_ids, next_token_scores, sequence_length,
             break
 
         # forward pass to get next token
-        cache_ids = torch.as_tensor([cur_len], dtype=torch.int32)
+        cache_ids.fill_(cur_len)
         next_token_scores = model(inputs, cache_ids, start_ids)
 
     if streamer:
         streamer.end()
 
     if output_scores:
-        return torch.cat(tokens, dim=-1), scores
+        return tokens, scores
 
-    return torch.cat(tokens, dim=-1)
+    return tokens
 
 
 def validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, min_tokens_to_keep):
@@ -130,75 +196,124 @@ def validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, min_tokens_to_keep):
 
 def top_k_top_p_filtering(scores, top_k, top_p, min_tokens_to_keep=1):
     validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, min_tokens_to_keep)
+    values, indices = select_top_k_top_p_filtering(top_k, top_p, min_tokens_to_keep)(scores)
+    # Without filtering the indices are a broadcast view, return a tensor that callers can write to
+    return values, indices.contiguous()
+
+
+def _safe_size(size, min_tokens_to_keep, input_size):
+    return min(max(size, min_tokens_to_keep), input_size)
+
 
+def _unfiltered(scores):
+    # Broadcast one arange over the batch rather than copying it into a (batch, input_size) tensor. Rows
+    # of the view share storage, so it is only used where the indices are read, e.g. per decode step.
     input_size = scores.size(dim=-1)
+    return scores, torch.arange(input_size, device=scores.device).expand(scores.size(dim=0), -1)
+
+
+def _cumsum_softmax(sorted_scores):
+    return torch.cumsum(torch.nn.functional.softmax(sorted_scores, dim=-1), dim=-1)
+
+
+def _mask_sorted_by_top_p(sorted_scores, cumulative_probs, top_p, min_tokens_to_keep):
+    mask = cumulative_probs <= top_p
+    mask[:, :min_tokens_to_keep] = True
 
-    def safe_size(size):
-        return min(max(size, min_tokens_to_keep), input_size)
-
-    def input_value_and_indices():
-        return scores, torch.arange(start=0, end=input_size).repeat([scores.size(dim=0), 1])
-
-    def filter_by_top_k():
-        return torch.topk(scores, safe_size(top_k))
-
-    def filter_by_top_p(indices=None):
-        """
-        indices==None indicates that top_k filtering was not performed, perform top_p filtering on the entire scores.
-        Otherwise, performs top_p filtering on the result of top_k filtering, and calculating cumulative probabilities
-        only on the filtered result from top_k filtering.
-        """
-        def filter_sorted(sorted_scores):
-            cumulative_probs = torch.cumsum(torch.nn.functional.softmax(sorted_scores, dim=-1), dim=-1)
-            mask = cumulative_probs <= top_p
-            mask[:, :min_tokens_to_keep] = True
-            n_to_keep = safe_size(mask.int().sum(dim=-1).max().item())
-            sorted_scores = sorted_scores[:, :n_to_keep]
-            mask = mask[:, :n_to_keep]
-
-            # Performed top_p on all batches. Need to return all batches' filtered values in one matrix. Therefore,
-            # we need to set the values that correspond to unwanted indices -- those that where mask has value False
-            # -- to -inf. This way subsequent sampling logic will not pick up these unwanted token indices.
-            sorted_scores[~mask] = -float('inf')
-            return sorted_scores
-
-        if indices is None:
-            # Not filtered by filter_by_top_k
-            ret_scores, ret_indices = torch.sort(scores, descending=True)
-            ret_scores = filter_sorted(ret_scores)
-            return ret_scores, ret_indices[:, :ret_scores.size(dim=-1)]
-
-        # Already filtered by filter_by_top_k, the value sequences represented by indices are already sorted.
-        ret_scores = filter_sorted(torch.gather(scores, 1, indices))
-        return ret_scores, indices[:, :ret_scores.size(dim=-1)]
-
-    if (top_k is None and top_p is None) or min_tokens_to_keep > input_size:
-        # Nothing to filter
-        return input_value_and_indices()
+    # Performed top_p on all batches. Need to return all batches' filtered values in one matrix. Therefore,
+    # we need to set the values that correspond to unwanted indices -- those that where mask has value False
+    # -- to -inf. This way subsequent sampling logic will not pick up these unwanted token indices. The
+    # matrix is not trimmed to the largest number of kept tokens, since that requires a host sync.
+    return sorted_scores.masked_fill(~mask, -float('inf'))
+
+
+def _filter_by_top_p(scores, top_p, min_tokens_to_keep):
+    # Rather than sorting the entire scores, first try only the highest scores. These suffice unless the
+    # next best score could still fall within top_p.
+    input_size = scores.size(dim=-1)
+    n_candidates = _safe_size(1024, min_tokens_to_keep, input_size)
+    covered = False
+    if n_candidates < input_size:
+        sorted_scores, sorted_indices = torch.topk(scores, n_candidates)
+        log_normalizer = torch.logsumexp(scores, dim=-1, keepdim=True)
+        cumulative_probs = torch.cumsum((sorted_scores - log_normalizer).exp_(), dim=-1)
+        covered = bool((cumulative_probs[:, -1] > top_p).all())
+    if not covered:
+        sorted_scores, sorted_indices = torch.sort(scores, descending=True)
+        cumulative_probs = _cumsum_softmax(sorted_scores)
+    return _mask_sorted_by_top_p(sorted_scores, cumulative_probs, top_p, min_tokens_to_keep), sorted_indices
+
+
+def select_top_k_top_p_filtering(top_k, top_p, min_tokens_to_keep=1, sort=True):
+    """
+    Selects the top_k_top_p_filtering case for fixed arguments once, rather than on every decode step.
+
+    Returns a function of the scores for the no-filter, top_k-only, top_p-only
+    or combined case. With `sort=False` the top_k-only candidates are returned
+    in arbitrary order, which is sufficient for sampling. Without filtering the
+    returned indices are a read-only broadcast view.
+    """
+    # Nothing to filter
+    if top_k is None and top_p is None:
+        return _unfiltered
 
     # Only filter by top_k
-    if top_k is not None and top_p is None:
-        return filter_by_top_k()
+    if top_p is None:
+        def filter_by_top_k(scores):
+            return torch.topk(scores, _safe_size(top_k, min_tokens_to_keep, scores.size(dim=-1)), sorted=sort)
+        return filter_by_top_k
 
     # Only filter by top_p
-    if top_k is None and top_p is not None:
-        return filter_by_top_p()
+    if top_k is None:
+        def filter_by_top_p(scores):
+            return _filter_by_top_p(scores, top_p, min_tokens_to_keep)
+        return filter_by_top_p
 
     # Filter by top_k followed by top_p
-    return filter_by_top_p(filter_by_top_k()[1])
+    def filter_by_top_k_top_p(scores):
+        # The values returned by topk are sorted, so cumulative probabilities are computed on them directly
+        values, indices = torch.topk(scores, _safe_size(top_k, min_tokens_to_keep, scores.size(dim=-1)))
+        return _mask_sorted_by_top_p(values, _cumsum_softmax(values), top_p, min_tokens_to_keep), indices
+    return filter_by_top_k_top_p
 
 
-def sample_loop_llama(model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id=2,
-                      top_k=50, top_p=1.0, temperature=1.0, streamer=None):
+def _validate_sampling_arguments(top_k, top_p, temperature):
     validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, None)
 
     if not isinstance(temperature, float) or not (temperature > 0):
         raise ValueError('temperature has to be a strictly positive float.')
 
+
+@torch.no_grad()
+def sample_loop_llama(model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id=2,
+                      top_k=50, top_p=1.0, temperature=1.0, streamer=None):
+    _validate_sampling_arguments(top_k, top_p, temperature)
+    return _sample_loop_llama(
+        model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id, top_k, top_p, temperature, streamer
+    )
+
+
+def _sample_loop_llama(model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id,
+                       top_k, top_p, temperature, streamer):
     # Flags, one per sequence in a batch, to indicate if a sequence hit eos_token_id
-    done_flags = torch.full((input_ids.size(dim=0), 1), False)
-    tokens = [input_ids]
+    done_flags = torch.zeros((input_ids.size(dim=0), 1), dtype=torch.bool, device=next_token_scores.device)
     _, start = input_ids.shape
+    cache_ids = torch.empty(1, dtype=torch.int32)
+
+    # Only the first `length` columns of the preallocated tokens are valid
+    tokens = allocate_tokens(input_ids, sequence_length)
+    length = start
+
+    # Scores returned by Neuron models live on the host, where checking whether all sequences are done is
+    # cheap and stops generation without extra forward passes. Only when the scores are on an accelerator,
+    # and no streamer already consumes every token on the host, avoid a device sync per step by checking
+    # every few steps and trimming the excess at the end.
+    deferred_done_check = next_token_scores.device.type != 'cpu' and not streamer
+    done_check_interval = 4 if deferred_done_check else 1
+
+    # Choose the filtering once, the arguments are fixed for the whole generation. A top_p of 1.0 keeps
+    # every token, so it is sampled without top_p filtering, and sampling does not depend on candidate order.
+    step_filter = select_top_k_top_p_filtering(top_k, None if top_p == 1.0 else top_p, sort=False)
 
     for cur_len in range(start, sequence_length):
         next_len = cur_len + 1
@@ -206,49 +321,60 @@ def sample_loop_llama(model, input_ids, start_ids, next_token_scores, sequence_l
         if temperature != 1.0:
             next_token_scores /= temperature
 
-        top_values, top_indices = top_k_top_p_filtering(next_token_scores, top_k=top_k, top_p=top_p)
+        top_values, top_indices = step_filter(next_token_scores)
 
         # sample
-        probs = torch.nn.functional.softmax(top_values, dim=-1)
-        inputs_in_topk = torch.multinomial(probs, num_samples=1, replacement=True)
+        inputs_in_topk = sample_categorical(top_values)
         inputs = torch.gather(top_indices, 1, inputs_in_topk)
 
         # Update done flags.
-        done_flags = torch.logical_or(done_flags, inputs == eos_token_id)
+        done_flags.logical_or_(inputs == eos_token_id)
         # Update token id to be eos_token_id if the corresponding done flag is True. For a batch,
         # this means that, while every sequence in the batch has the same length, a sequence that
         # encounters eos_token_id earlier will be filled with eos_token_ids post the first appearance
         # of eos_token_id.
 
-        token = torch.where(done_flags.eq(True), eos_token_id, inputs)
-        tokens.append(token)
+        token = inputs.masked_fill(done_flags, eos_token_id)
+        tokens[:, cur_len:next_len] = token
+        length = next_len
 
         if streamer is not None and hasattr(streamer, 'response_with_prefix') and streamer.response_with_prefix:
-             streamer.put(torch.cat(tokens, dim=-1))
+             streamer.put(tokens[:, :length])
         elif streamer:
             streamer.put(token)
 
-        if next_len >= sequence_length or done_flags.all():
+        if next_len >= sequence_length or ((length - start) % done_check_interval == 0 and done_flags.all()):
             break
 
         # forward pass to get next token
-        cache_ids = torch.as_tensor([cur_len], dtype=torch.int32)
+        cache_ids.fill_(cur_len)
         next_token_scores = model(inputs, cache_ids, start_ids)
 
     if streamer:
         streamer.end()
 
-    return torch.cat(tokens, dim=-1)
+    # A step emits eos_token_id for every sequence only once all of them are done. Stop at the first
+    # such step, which the deferred check above may have overshot.
+    if deferred_done_check:
+        all_done = (tokens[:, start:length] == eos_token_id).all(dim=0).nonzero()
+        if all_done.numel():
+            length = start + all_done[0].item() + 1
+
+    if length < tokens.size(dim=1):
+        # Stopped early, return a compact copy rather than a strided view into the preallocated tokens
+        return tokens[:, :length].clone()
+    return tokens
 
 
 @torch.no_grad()
 def sample_llama(model, input_ids, start_ids, sequence_length, eos_token_id=2, top_k=50, top_p=1.0, temperature=1.0, streamer=None):
-    validate_top_k_top_p_min_tokens_to_keep(top_k, top_p, None)
+    # Validate before populating the caches, the private loop does not re-validate
+    _validate_sampling_arguments(top_k, top_p, temperature)
 
     # populate key/value caches according to the prompt text
     _, start = input_ids.shape
     cache_ids = torch.arange(start, dtype=torch.int32)
     next_token_scores = model(input_ids, cache_ids, start_ids)
-    return sample_loop_llama(
+    return _sample_loop_llama(
         model, input_ids, start_ids, next_token_scores, sequence_length, eos_token_id, top_k, top_p, temperature, streamer
     )